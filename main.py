@@ -1,11 +1,62 @@
 import configparser
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import subprocess
 import csv
+import functools
+import itertools
 import logging
-from typing import List
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional
 
 CONFIG_FILE_PATH = "config.ini"
+GITLAB_API_URL = "https://gitlab.com/api/v4"
+PER_PAGE = 100
+MAX_CONCURRENT_REQUESTS = 16
+MAX_REQUESTS_PER_SECOND = 10
+RATE_LIMIT_MIN_REMAINING = 10
+CX_MAX_PROJECTS_ARG_LENGTH = 30000  # Windows limits a whole command line to 32767 characters
+CSV_BUFFER_SIZE = 1 << 20
+HTTP_CACHE_NAME = "gitlab_http_cache"
+
+# Extracts the URL of the next page from a Link header
+NEXT_LINK_PATTERN = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+# Characters that make the csv module quote a field
+CSV_QUOTED_CHARS = re.compile(r'[,"\r\n]')
+
+# Keep cx.exe from allocating a console window on Windows (the flag is 0 elsewhere)
+CX_CREATION_FLAGS = getattr(subprocess, "CREATE_NO_WINDOW", 0)
+
+# Share one connection pool across all GitLab API requests, retrying rate-limited and failed requests.
+# Responses are cached on disk and revalidated with their ETag, so unchanged pages come back as an
+# empty 304. Responses without caching directives expire immediately, so every page is revalidated
+# with GitLab using the current API key, which is left out of the cache file.
+session = requests_cache.CachedSession(
+    cache_name=HTTP_CACHE_NAME,
+    backend='sqlite',
+    expire_after=0,
+    cache_control=True,
+    ignored_parameters=['PRIVATE-TOKEN']
+)
+session.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=20,
+    max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[429, 502, 503, 504], raise_on_status=False)
+))
+
+# Limit the number of GitLab API requests in flight at once across all threads
+request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+# Earliest time the next GitLab API request may start, shared across all threads
+rate_limit_lock = threading.Lock()
+next_request_time = 0.0
 
 # Set up logging
 logging.basicConfig(
@@ -15,9 +66,13 @@ logging.basicConfig(
 )
 
 # Create a ConfigParser instance to read the API key and OAuth token
+config = configparser.ConfigParser()
+config.read(CONFIG_FILE_PATH)
+
+@functools.lru_cache(maxsize=None)
 def get_config(section: str, key: str) -> str:
     """
-    Read the configuration file to get the specified key from a given section.
+    Look up the specified key from a given section of the configuration file.
 
     Args:
         section (str): The section in the config file.
@@ -26,14 +81,184 @@ def get_config(section: str, key: str) -> str:
     Returns:
         str: The value of the specified key in the given section.
     """
-    config = configparser.ConfigParser()
     try:
-        config.read(CONFIG_FILE_PATH)
         return config[section][key]
     except KeyError as e:
         logging.error(f"Key error: {e}")
         raise ValueError(f"Key '{key}' not found in section '{section}' of config file.")
 
+# Function to space out GitLab API requests
+def wait_for_rate_limit():
+    """
+    Block until another GitLab API request may be sent without exceeding MAX_REQUESTS_PER_SECOND.
+    """
+    global next_request_time
+    with rate_limit_lock:
+        now = time.monotonic()
+        start_time = max(now, next_request_time)
+        next_request_time = start_time + 1 / MAX_REQUESTS_PER_SECOND
+    time.sleep(start_time - now)
+
+# Function to hold off GitLab API requests when the rate limit is nearly used up
+def pause_for_rate_limit_reset(response: requests.Response):
+    """
+    Delay all further GitLab API requests until the rate limit window resets when the response
+    reports fewer than RATE_LIMIT_MIN_REMAINING requests left, instead of running into 429s.
+
+    Args:
+        response (requests.Response): A response fresh from the GitLab API.
+    """
+    global next_request_time
+    remaining = response.headers.get('RateLimit-Remaining')
+    reset = response.headers.get('RateLimit-Reset')
+    if remaining is None or reset is None or int(remaining) >= RATE_LIMIT_MIN_REMAINING:
+        return
+    delay = float(reset) - time.time()
+    if delay <= 0:
+        return
+    logging.warning(f"GitLab rate limit nearly reached ({remaining} requests left), pausing for {delay:.0f}s")
+    with rate_limit_lock:
+        next_request_time = max(next_request_time, time.monotonic() + delay)
+
+# Function to issue a single GET request against the GitLab API
+def send_request(url: str, headers: dict, params: Optional[dict], description: str) -> Optional[requests.Response]:
+    """
+    Send one GET request to the GitLab API, holding a request slot for its duration.
+
+    Args:
+        url (str): The URL to fetch.
+        headers (dict): The request headers, including the API key.
+        params (Optional[dict]): Query parameters for the request.
+        description (str): What is being fetched, used in log messages.
+
+    Returns:
+        Optional[requests.Response]: The response, or None if a network error occurred.
+    """
+    wait_for_rate_limit()
+    try:
+        with request_slots:
+            response = session.get(url, headers=headers, params=params)
+    except requests.RequestException as e:
+        logging.error(f"Network error occurred while fetching {description}: {e}")
+        return None
+    # Responses served from the cache without a request carry the rate limit headers from when they
+    # were stored; revalidated ones count against the limit and have their headers refreshed by the 304
+    if not response.from_cache or getattr(response, 'revalidated', False):
+        pause_for_rate_limit_reset(response)
+    return response
+
+# Function to fetch a single page from the GitLab API
+def fetch_page(url: str, headers: dict, params: Optional[dict], description: str) -> Optional[requests.Response]:
+    """
+    Fetch one page from the GitLab API.
+
+    Args:
+        url (str): The URL of the page to fetch.
+        headers (dict): The request headers, including the API key.
+        params (Optional[dict]): Query parameters for the request.
+        description (str): What is being fetched, used in log messages.
+
+    Returns:
+        Optional[requests.Response]: The response, or None if the request failed.
+    """
+    response = send_request(url, headers, params, description)
+    if response is None:
+        return None
+    if response.status_code != 200:
+        logging.error(f"Error fetching {description}: {response.status_code}, {response.text}")
+        return None
+    return response
+
+# Function to find the next page of a paginated response
+def get_next_url(response: requests.Response) -> Optional[str]:
+    """
+    Get the URL of the next page from the response's Link header.
+
+    Args:
+        response (requests.Response): A page returned by the GitLab API.
+
+    Returns:
+        Optional[str]: The URL of the next page, or None if this is the last page.
+    """
+    match = NEXT_LINK_PATTERN.search(response.headers.get('Link', ''))
+    return match.group(1) if match else None
+
+# Function to fetch every page of a GitLab list endpoint
+def paginate(url: str, api_key: str, description: str, keyset: bool = False,
+             params: Optional[dict] = None) -> Iterator[dict]:
+    """
+    Yield all items from a paginated GitLab API endpoint, one page at a time.
+
+    Items are yielded as each page is parsed rather than collected into one list, so callers
+    can keep just the fields they need instead of every full item.
+
+    With keyset pagination the 'next' links are followed one page at a time, which keeps
+    each page cheap for GitLab to serve however large the collection is. Endpoints that
+    reject keyset pagination with a 405 or 400 fall back to offset pagination. Some endpoints
+    ignore the keyset parameters and answer with offset pages instead; those pages are then
+    requested with the same order_by/sort as the first one, so the page order stays consistent.
+
+    For offset pagination the first page is fetched on its own to read the X-Total-Pages
+    header, after which the remaining pages are fetched concurrently. GitLab omits that
+    header for very large collections, in which case the 'next' links are followed instead.
+
+    Args:
+        url (str): The URL of the list endpoint.
+        api_key (str): The GitLab API key for authentication.
+        description (str): What is being fetched, used in log messages.
+        keyset (bool): Whether to try keyset pagination first.
+        params (Optional[dict]): Extra query parameters, such as filters, sent with every page.
+
+    Yields:
+        dict: The items from all pages, in page order.
+    """
+    headers = {"PRIVATE-TOKEN": api_key}
+    params = params or {}
+    response = None
+    if keyset:
+        keyset_params = {**params, 'pagination': 'keyset', 'per_page': PER_PAGE, 'order_by': 'id', 'sort': 'asc'}
+        response = send_request(url, headers, keyset_params, description)
+        if response is None:
+            return
+        if response.status_code in (400, 405):
+            logging.info(f"Keyset pagination not supported for {description}, using offset pagination")
+            response = None
+        elif response.status_code != 200:
+            logging.error(f"Error fetching {description}: {response.status_code}, {response.text}")
+            return
+        else:
+            # Keep the keyset sort order if GitLab answered with offset pages instead
+            params = {**params, 'order_by': 'id', 'sort': 'asc'}
+
+    if response is None:
+        response = fetch_page(url, headers, {**params, 'page': 1, 'per_page': PER_PAGE}, description)
+        if response is None:
+            return
+    yield from response.json()
+
+    total_pages = response.headers.get('X-Total-Pages')
+    if total_pages:
+        remaining_pages = range(2, int(total_pages) + 1)
+        if remaining_pages:
+            with ThreadPoolExecutor(max_workers=min(len(remaining_pages), MAX_CONCURRENT_REQUESTS)) as executor:
+                responses = executor.map(
+                    lambda page: fetch_page(url, headers, {**params, 'page': page, 'per_page': PER_PAGE}, description),
+                    remaining_pages
+                )
+                for page_response in responses:
+                    if page_response is None:
+                        break
+                    yield from page_response.json()
+        return
+
+    next_url = get_next_url(response)
+    while next_url:
+        response = fetch_page(next_url, headers, None, description)
+        if response is None:
+            break
+        yield from response.json()
+        next_url = get_next_url(response)
+
 # Function to fetch all groups the API has access to
 def get_groups(api_key: str) -> List[dict]:
     """
@@ -45,32 +270,12 @@ def get_groups(api_key: str) -> List[dict]:
     Returns:
         List[dict]: A list of groups with their details.
     """
-    GITLAB_GROUPS_URL = "https://gitlab.com/api/v4/groups"
-    headers = {"PRIVATE-TOKEN": api_key}
-    groups = []
-    page = 1
-
-    while True:
-        try:
-            response = requests.get(GITLAB_GROUPS_URL, headers=headers, params={'page': page, 'per_page': 100})
-            if response.status_code != 200:
-                logging.error(f"Error fetching groups: {response.status_code}, {response.text}")
-                break
-            group_data = response.json()
-            if not group_data:
-                break
-            groups.extend(group_data)
-            page += 1
-        except requests.RequestException as e:
-            logging.error(f"Network error occurred while fetching groups: {e}")
-            break
-
-    return groups
+    return list(paginate(f"{GITLAB_API_URL}/groups", api_key, "groups"))
 
 # Function to fetch projects from the GitLab group
 def get_group_projects(api_key: str, group_id: str) -> List[str]:
     """
-    Fetch all projects for a given group from GitLab.
+    Fetch all projects for a given group from GitLab, including the projects of its subgroups.
 
     Args:
         api_key (str): The GitLab API key for authentication.
@@ -79,36 +284,21 @@ def get_group_projects(api_key: str, group_id: str) -> List[str]:
     Returns:
         List[str]: A list of full path/namespaces of the projects.
     """
-    GITLAB_GROUP_URL = f"https://gitlab.com/api/v4/groups/{group_id}/projects"
-    headers = {"PRIVATE-TOKEN": api_key}
-    projects = []
-    page = 1
-
-    while True:
-        try:
-            response = requests.get(GITLAB_GROUP_URL, headers=headers, params={'page': page, 'per_page': 100})
-            if response.status_code != 200:
-                logging.error(f"Error fetching projects for group {group_id}: {response.status_code}, {response.text}")
-                break
-            project_data = response.json()
-            if not project_data:
-                break
-            projects.extend([project['path_with_namespace'] for project in project_data])
-            page += 1
-        except requests.RequestException as e:
-            logging.error(f"Network error occurred while fetching projects for group {group_id}: {e}")
-            break
-
-    return projects
+    project_data = paginate(f"{GITLAB_API_URL}/groups/{group_id}/projects", api_key, f"projects for group {group_id}",
+                            keyset=True, params={'include_subgroups': 'true'})
+    return [project['path_with_namespace'] for project in project_data]
 
 # Function to run cx.exe with OAuth token and projects from CSV
-def run_cx_exe(oauth_token: str, projects: str):
+def run_cx_exe(oauth_token: str, projects: str) -> Optional[str]:
     """
     Run cx.exe with the provided OAuth token and project list.
 
     Args:
         oauth_token (str): OAuth token for authentication.
         projects (str): Comma-separated list of projects.
+
+    Returns:
+        Optional[str]: The cleaned cx.exe output, or None if the run failed.
     """
     command = [
         "cx.exe",  # Path to cx.exe
@@ -121,16 +311,73 @@ def run_cx_exe(oauth_token: str, projects: str):
     ]
 
     try:
-        result = subprocess.run(command, capture_output=True, text=True, encoding='utf-8')
+        result = subprocess.run(command, capture_output=True, text=True, encoding='utf-8',
+                                creationflags=CX_CREATION_FLAGS)
         if result.returncode == 0:
             logging.info("Contributor count successful.")
-            cleaned_output = result.stdout.replace('\xa0', ' ').strip()
-            with open('output.txt', 'w+') as f:
-                f.write(cleaned_output)
-        else:
-            logging.error(f"cx.exe returned error: {result.stderr}")
+            return result.stdout.replace('\xa0', ' ').strip()
+        logging.error(f"cx.exe returned error: {result.stderr}")
     except Exception as e:
         logging.error(f"Error occurred while running cx.exe: {e}")
+    return None
+
+# Function to split the project list into command-line sized batches
+def split_projects(projects: List[str]) -> List[str]:
+    """
+    Join the projects into as few comma-separated lists as possible, each no longer than
+    CX_MAX_PROJECTS_ARG_LENGTH characters.
+
+    Args:
+        projects (List[str]): Full path/namespaces of the projects.
+
+    Returns:
+        List[str]: Comma-separated project lists, in project order.
+    """
+    batches = []
+    batch = []
+    batch_length = 0
+    for project in projects:
+        # Account for the comma that joins this project to the rest of the batch
+        if batch and batch_length + 1 + len(project) > CX_MAX_PROJECTS_ARG_LENGTH:
+            batches.append(','.join(batch))
+            batch = []
+            batch_length = 0
+        batch_length += len(project) + (1 if batch else 0)
+        batch.append(project)
+    if batch:
+        batches.append(','.join(batch))
+    return batches
+
+# Function to run cx.exe over all projects, in parallel batches when the list is too long
+def run_cx_exe_batches(oauth_token: str, projects: List[str]):
+    """
+    Run cx.exe over the projects and write its output to output.txt.
+
+    The projects are passed to a single cx.exe run unless the list is too long for one
+    command line, in which case it is split into batches that run in parallel. cx.exe counts
+    unique contributors per run, so a contributor active in several batches is counted in
+    each of them and the per-batch counts cannot be summed. output.txt is only written when
+    every batch succeeded.
+
+    Args:
+        oauth_token (str): OAuth token for authentication.
+        projects (List[str]): Full path/namespaces of the projects.
+    """
+    batches = split_projects(projects)
+    if not batches:
+        return
+    if len(batches) > 1:
+        logging.warning(f"Project list is too long for one cx.exe run, splitting it into {len(batches)} batches. "
+                        "Contributor counts are per batch and cannot be summed.")
+
+    with ThreadPoolExecutor(max_workers=min(len(batches), os.cpu_count() or 1)) as executor:
+        outputs = list(executor.map(lambda batch: run_cx_exe(oauth_token, batch), batches))
+
+    if None in outputs:
+        logging.error(f"{outputs.count(None)} of {len(batches)} cx.exe runs failed, output.txt was not written.")
+        return
+    with open('output.txt', 'w+') as f:
+        f.write('\n\n'.join(outputs))
 
 if __name__ == "__main__":
     # Pull API key and OAuth token from config.ini
@@ -147,35 +394,44 @@ if __name__ == "__main__":
     if not groups:
         logging.warning("No groups found or unable to access groups.")
     else:
-        all_projects = []
+        # Subgroup projects are fetched along with their highest accessible ancestor group,
+        # so only groups whose parent is not in the list need to be queried
+        group_ids = {group['id'] for group in groups}
+        top_groups = [group for group in groups if group.get('parent_id') not in group_ids]
+
+        # Fetch all projects from each group, several groups at a time
+        def fetch_group(group: dict) -> List[str]:
+            logging.info(f"Fetching projects for group: {group['name']}")
+            return get_group_projects(api_key, str(group['id']))
 
-        # Fetch all projects from each group
-        for group in groups:
-            group_name = group['name']
-            group_id = group['id']
-            logging.info(f"Fetching projects for group: {group_name}")
-            projects = get_group_projects(api_key, str(group_id))
-            all_projects.extend(projects)
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            group_projects = list(executor.map(fetch_group, top_groups))
+        # Drop projects listed under more than one group, keeping the first occurrence
+        all_projects = list(dict.fromkeys(itertools.chain.from_iterable(group_projects)))
 
         # Write all project full paths to a CSV file
         csv_file_path = "gitlab_projects.csv"
         try:
-            with open(csv_file_path, 'w+', newline='') as csv_file:
-                writer = csv.writer(csv_file)
-                writer.writerow(all_projects)  # Write the project full paths separated by commas
+            if CSV_QUOTED_CHARS.search(''.join(all_projects)):
+                with open(csv_file_path, 'w', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE) as csv_file:
+                    writer = csv.writer(csv_file)
+                    writer.writerow(all_projects)  # Write the project full paths separated by commas
+            else:
+                # No path needs quoting, so the row is just the paths joined by commas
+                with open(csv_file_path, 'wb') as csv_file:
+                    csv_file.write(','.join(all_projects).encode('utf-8') + b'\r\n')
             logging.info(f"Project full paths have been written to {csv_file_path}")
         except Exception as e:
             logging.error(f"Error writing to CSV file: {e}")
 
         # Now that projects are written to CSV, read the CSV and use the projects in cx.exe
         try:
-            with open(csv_file_path, 'r') as csvfile:
+            with open(csv_file_path, 'r', newline='', encoding='utf-8') as csvfile:
                 reader = csv.reader(csvfile)
                 projects_from_csv = next(reader)  # Assuming a single line of projects
-                project_list = ','.join(projects_from_csv)
 
                 # Run cx.exe with the projects from CSV
-                run_cx_exe(oauth_token, project_list)
+                run_cx_exe_batches(oauth_token, projects_from_csv)
 
         except FileNotFoundError:
             logging.error(f"CSV file '{csv_file_path}' not found.")